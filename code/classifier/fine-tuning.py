@@ -1,12 +1,16 @@
 import argparse
 import pandas as pd
 import torch
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, Trainer, TrainingArguments
+from datasets import Dataset, load_from_disk
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSequenceClassification, DataCollatorWithPadding, Trainer, TrainingArguments
 from sklearn.model_selection import StratifiedKFold
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 from sklearn.utils.class_weight import compute_class_weight
+import hashlib
 import os
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 class CustomTrainer(Trainer):
@@ -15,7 +19,8 @@ class CustomTrainer(Trainer):
         self.class_weights = class_weights
 
     def compute_loss(self, model, inputs, return_outputs=False):
-        labels = inputs.pop("labels")
+        # Labels travel through the pipeline as int8; CrossEntropyLoss needs int64
+        labels = inputs.pop("labels").long()
         outputs = model(**inputs)
         logits = outputs.logits
         if self.class_weights is not None:
@@ -78,19 +83,19 @@ def load_data(input_csv, multiclass):
     df = df.dropna(subset=['emotion-A', 'emotion-B'], how='all')
 
     if multiclass:
-        # Use the first valid emotion (priority to 'emotion-A' if both are valid)
-        df['labels'] = df[['emotion-A', 'emotion-B']].apply(
-            lambda x: MULTICLASS_LABEL_MAP[x['emotion-A']] if pd.notna(x['emotion-A']) 
-                      else MULTICLASS_LABEL_MAP[x['emotion-B']], 
-            axis=1
+        # Use the first valid emotion (priority to 'emotion-A' if both are valid);
+        # vectorized .map with a fillna fallback instead of a row-wise apply
+        df['labels'] = (
+            df['emotion-A'].map(MULTICLASS_LABEL_MAP)
+            .fillna(df['emotion-B'].map(MULTICLASS_LABEL_MAP))
+            .astype(np.int8)
         )
     else:
+        # Vectorized boolean masks instead of a per-row apply for each emotion
         binary_labels = {}
         for emotion in MULTICLASS_LABEL_MAP.keys():
-            df[f"{emotion}_label"] = df[['emotion-A', 'emotion-B']].apply(
-                lambda x: BINARY_LABEL_MAP['Positive'] if emotion in [x['emotion-A'], x['emotion-B']] else BINARY_LABEL_MAP['Negative'],
-                axis=1
-            )
+            positive = (df['emotion-A'] == emotion) | (df['emotion-B'] == emotion)
+            df[f"{emotion}_label"] = positive.astype(np.int8)
             binary_labels[emotion] = df[f"{emotion}_label"].to_numpy()
         logger.info("Binary labels prepared for emotions.")
         return df, binary_labels
@@ -101,8 +106,9 @@ def load_data(input_csv, multiclass):
 
 def display_emotion_counts(df):
     # Count occurrences of each emotion in emotion-A and emotion-B columns
-    emotion_counts = df[['emotion-A', 'emotion-B']].stack().value_counts()
-    
+    # (concat avoids the stacked MultiIndex intermediate)
+    emotion_counts = pd.concat([df['emotion-A'], df['emotion-B']], ignore_index=True).value_counts()
+
     # Display counts
     logger.info("Number of instances per emotion:")
     for emotion, count in emotion_counts.items():
@@ -116,16 +122,98 @@ def display_emotion_counts_binary(df):
         logger.info(f'{emotion}\t\t' + str((df[f'{emotion}_label'] == 1).sum()) + '\t\t' + str((df[f'{emotion}_label'] == 0).sum()))
     return
 
-def preprocess_data(texts, labels, tokenizer):
-    logger.info("Preprocessing data with tokenizer %s", tokenizer.name_or_path)
-    encodings = tokenizer(texts, truncation=True, padding=True, max_length=128)
-    return encodings, labels
+MAX_LENGTH = 128
+
+def preprocess_data(texts, tokenizer, cache_dir="./tokenizer_cache"):
+    # Tokenize the full corpus once; the fold loops slice the encodings by index
+    # instead of re-tokenizing the overlapping train/test splits per fold.
+    # Encodings are also memoized on disk, keyed by tokenizer, max_length and
+    # the texts themselves, so repeated runs (hyperparameter sweeps) skip the
+    # tokenization entirely.
+    texts = list(texts)  # accept Series/ndarray/list; a single pointer copy
+    cache_key = hashlib.md5(
+        "\n".join([tokenizer.name_or_path, str(MAX_LENGTH)] + texts).encode("utf-8")
+    ).hexdigest()
+    cache_path = os.path.join(cache_dir, cache_key)
+    if os.path.isdir(cache_path):
+        logger.info("Loading cached encodings from %s", cache_path)
+        return load_from_disk(cache_path)
+
+    # padding=False: the DataCollatorWithPadding pads each batch to its own max
+    # length at collation time instead of padding everything to the corpus max.
+    logger.info("Tokenizing %d texts with tokenizer %s", len(texts), tokenizer.name_or_path)
+    encodings = tokenizer(texts, truncation=True, padding=False, max_length=MAX_LENGTH)
+    encoded = Dataset.from_dict(dict(encodings))
+    # Precompute sequence lengths so group_by_length can bucket same-length
+    # examples into batches without walking input_ids at sampling time
+    encoded = encoded.map(lambda batch: {"length": [len(ids) for ids in batch["input_ids"]]}, batched=True)
+    encoded.save_to_disk(cache_path)
+    logger.info("Cached encodings at %s", cache_path)
+    return encoded
+
+def build_dataset(encoded, labels):
+    # Arrow-backed Dataset: fold splits become zero-copy select() views instead
+    # of per-example dicts of freshly allocated tensors.
+    dataset = encoded.add_column("labels", np.asarray(labels))
+    dataset.set_format("torch")
+    return dataset
+
+def load_pretrained_snapshot(model_id, num_labels):
+    # Load the pretrained weights from disk/HF cache once; folds rebuild the
+    # model from the in-memory state_dict instead of re-reading the checkpoint.
+    logger.info("Loading pretrained snapshot for %s (num_labels=%d)", model_id, num_labels)
+    config = AutoConfig.from_pretrained(model_id, num_labels=num_labels)
+    state_dict = AutoModelForSequenceClassification.from_pretrained(model_id, num_labels=num_labels).state_dict()
+    return config, state_dict
+
+def load_fold_model(config, state_dict):
+    model = AutoModelForSequenceClassification.from_config(config)
+    model.load_state_dict(state_dict)
+    return model
+
+def load_training_args(output_dir):
+    # Mixed precision: bf16 on Ampere+ GPUs, fp16 elsewhere (Trainer handles
+    # autocast/GradScaler internally). tf32 and the fused optimizer are CUDA-only.
+    use_cuda = torch.cuda.is_available()
+    use_bf16 = use_cuda and torch.cuda.is_bf16_supported()
+    return TrainingArguments(
+        output_dir=output_dir,
+        num_train_epochs=10,
+        per_device_train_batch_size=64,
+        per_device_eval_batch_size=128,
+        gradient_accumulation_steps=1,
+        gradient_checkpointing=True,
+        group_by_length=True,
+        length_column_name="length",
+        dataloader_num_workers=min(4, os.cpu_count() or 1),
+        dataloader_pin_memory=True,
+        dataloader_persistent_workers=True,
+        eval_strategy="epoch",
+        # Trace the model with TorchScript for the eval-only forward passes
+        jit_mode_eval=use_cuda,
+        save_strategy="no",
+        report_to="none",
+        bf16=use_bf16,
+        fp16=use_cuda and not use_bf16,
+        tf32=use_bf16,
+        optim="adamw_torch_fused" if use_cuda else "adamw_torch",
+        torch_compile=use_cuda,
+        torch_compile_backend="inductor" if use_cuda else None,
+        # Multi-GPU: launch with `torchrun --nproc_per_node=N` so the Trainer
+        # uses DDP over NCCL instead of falling back to DataParallel.
+        ddp_backend="nccl" if use_cuda else None,
+        ddp_find_unused_parameters=False
+    )
 
 def compute_metrics(predictions):
     preds, labels = predictions
     preds = preds.argmax(axis=1)  # Get predicted class indices
     accuracy = accuracy_score(labels, preds)
-    precision, recall, f1, support = precision_recall_fscore_support(labels, preds, average=None)
+    # Fixed label set keeps the per-class vectors the same length on every fold
+    # (no per-call class discovery) even if a fold misses a class entirely
+    precision, recall, f1, support = precision_recall_fscore_support(
+        labels, preds, labels=list(range(len(MULTICLASS_LABEL_MAP))), average=None, zero_division=0
+    )
 
     # Convert per-class metrics to a dictionary with class names
     per_class_metrics = {
@@ -169,22 +257,29 @@ def compute_metrics_binary(predictions):
 def cross_validate_binary_models(model_id, tokenizer_id, texts, binary_labels, k=10, output_dir="./output", use_class_weights=False):
     logger.info("Starting binary cross-validation with k=%d", k)
     tokenizer = AutoTokenizer.from_pretrained(tokenizer_id)
+    config, base_state_dict = load_pretrained_snapshot(model_id, num_labels=2)
+    encoded_texts = preprocess_data(texts, tokenizer)
+    data_collator = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8)
 
     metrics = {}
-    
+
     for emotion, labels in binary_labels.items():
         logger.info("Processing binary classifier for emotion: %s", emotion)
         skf = StratifiedKFold(n_splits=k, shuffle=True, random_state=42)
-        
+        full_dataset = build_dataset(encoded_texts, labels)
+
         fold_metrics = []
-        for fold, (train_idx, test_idx) in enumerate(skf.split(texts, labels)):
+        # Stratification only looks at labels; a cheap placeholder spares sklearn
+        # from validating the object-dtype texts array on every split
+        for fold, (train_idx, test_idx) in enumerate(skf.split(np.zeros(len(labels)), labels)):
             logger.info("Processing fold %d/%d for emotion %s", fold + 1, k, emotion)
             logger.info("Training instances %d", len(train_idx))
             logger.info("Testing instances %d", len(test_idx))
-            
+
             # Split data
-            train_texts, test_texts = texts[train_idx], texts[test_idx]
-            train_labels, test_labels = labels[train_idx], labels[test_idx]
+            train_labels = labels[train_idx]
+            train_dataset = full_dataset.select(train_idx)
+            test_dataset = full_dataset.select(test_idx)
 
             # Class weights
             if use_class_weights:
@@ -193,36 +288,15 @@ def cross_validate_binary_models(model_id, tokenizer_id, texts, binary_labels, k
                     classes=np.unique(train_labels),
                     y=train_labels
                 )
-                class_weights = torch.tensor(class_weights, dtype=torch.float).to("cuda" if torch.cuda.is_available() else "cpu")
+                class_weights = torch.from_numpy(class_weights.astype(np.float32, copy=False)).to("cuda" if torch.cuda.is_available() else "cpu")
             else:
                 class_weights = None
             
-            # Preprocess
-            train_encodings, train_labels = preprocess_data(train_texts.tolist(), train_labels.tolist(), tokenizer)
-            test_encodings, test_labels = preprocess_data(test_texts.tolist(), test_labels.tolist(), tokenizer)
-            
-            train_dataset = [
-                {key: torch.tensor(val[i]) for key, val in train_encodings.items()} | {"labels": torch.tensor(train_labels[i])}
-                for i in range(len(train_labels))
-            ]
-            test_dataset = [
-                {key: torch.tensor(val[i]) for key, val in test_encodings.items()} | {"labels": torch.tensor(test_labels[i])}
-                for i in range(len(test_labels))
-            ]
-            
             # Load model
-            model = AutoModelForSequenceClassification.from_pretrained(model_id, num_labels=2)
-            
+            model = load_fold_model(config, base_state_dict)
+
             # Define training arguments
-            training_args = TrainingArguments(
-                output_dir=os.path.join(output_dir, f"{emotion}_fold-{fold}"),
-                num_train_epochs=10,
-                per_device_train_batch_size=16,
-                eval_strategy="epoch",
-                save_strategy="no",
-                #logging_dir=os.path.join(output_dir, f"{emotion}_fold-{fold}/logs"),
-                report_to="none"
-            )
+            training_args = load_training_args(os.path.join(output_dir, f"{emotion}_fold-{fold}"))
             
             # Define Trainer
             trainer = CustomTrainer(
@@ -231,6 +305,7 @@ def cross_validate_binary_models(model_id, tokenizer_id, texts, binary_labels, k
                 train_dataset=train_dataset,
                 eval_dataset=test_dataset,
                 compute_metrics=compute_metrics_binary,
+                data_collator=data_collator,
                 class_weights=class_weights
             )
             
@@ -255,84 +330,103 @@ def cross_validate_binary_models(model_id, tokenizer_id, texts, binary_labels, k
     logger.info("Binary classifier metrics saved to %s", metrics_csv)
     return metrics
 
+def run_fold(fold, train_idx, test_idx, full_dataset, labels, config, base_state_dict,
+             data_collator, output_dir, use_class_weights, gpu_id=None):
+    if gpu_id is not None:
+        # Pin this fold to one GPU; must happen before any CUDA call in the
+        # worker process.
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
+    logger.info("Processing fold %d", fold + 1)
+    logger.info("Training instances %d", len(train_idx))
+    logger.info("Testing instances %d", len(test_idx))
+
+    # Split data
+    train_labels = labels[train_idx]
+    train_dataset = full_dataset.select(train_idx)
+    test_dataset = full_dataset.select(test_idx)
+
+    # Class weights
+    if use_class_weights:
+        class_weights = compute_class_weight(
+            class_weight='balanced',
+            classes=np.unique(train_labels),
+            y=train_labels
+        )
+        class_weights = torch.from_numpy(class_weights.astype(np.float32, copy=False)).to("cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        class_weights = None
+
+    # Load model
+    model = load_fold_model(config, base_state_dict)
+
+    # Define training arguments
+    training_args = load_training_args(os.path.join(output_dir, f"fold-{fold}"))
+
+    # Define Trainer
+    trainer = CustomTrainer(
+        model=model,
+        args=training_args,
+        train_dataset=train_dataset,
+        eval_dataset=test_dataset,
+        compute_metrics=compute_metrics,
+        data_collator=data_collator,
+        class_weights=class_weights
+    )
+
+    # Train and evaluate
+    trainer.train()
+    eval_metrics = trainer.evaluate()
+    logger.info("Fold %d metrics: %s", fold + 1, eval_metrics)
+    return eval_metrics
+
 def cross_validate_model(model_id, tokenizer_id, texts, labels, k=10, multiclass=True, output_dir="./output", use_class_weights=False):
     logger.info("Starting cross-validation with k=%d", k)
     skf = StratifiedKFold(n_splits=k, shuffle=True, random_state=42)
     tokenizer = AutoTokenizer.from_pretrained(tokenizer_id)
+    config, base_state_dict = load_pretrained_snapshot(
+        model_id, num_labels=len(MULTICLASS_LABEL_MAP) if multiclass else 2
+    )
+    encoded_texts = preprocess_data(texts, tokenizer)
+    data_collator = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8)
+    full_dataset = build_dataset(encoded_texts, labels)
+
+    # Stratification only looks at labels; a cheap placeholder spares sklearn
+    # from validating the object-dtype texts array on every split
+    folds = list(enumerate(skf.split(np.zeros(len(labels)), labels)))
+    n_gpus = torch.cuda.device_count()
+
+    if n_gpus > 1 and "LOCAL_RANK" not in os.environ:
+        # Folds are independent, so run them round-robin across the GPUs in
+        # separate processes (no all-reduce needed, unlike DDP within a fold).
+        # Skipped under torchrun, where DDP already owns the GPUs.
+        logger.info("Running %d folds in parallel across %d GPUs", k, n_gpus)
+        mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=n_gpus, mp_context=mp_context) as pool:
+            futures = [
+                pool.submit(
+                    run_fold, fold, train_idx, test_idx, full_dataset, labels,
+                    config, base_state_dict, data_collator, output_dir,
+                    use_class_weights, gpu_id=fold % n_gpus
+                )
+                for fold, (train_idx, test_idx) in folds
+            ]
+            all_eval_metrics = [future.result() for future in futures]
+    else:
+        all_eval_metrics = [
+            run_fold(fold, train_idx, test_idx, full_dataset, labels, config,
+                     base_state_dict, data_collator, output_dir, use_class_weights)
+            for fold, (train_idx, test_idx) in folds
+        ]
 
     fold_metrics = []
     all_per_class_metrics = []
-
-    for fold, (train_idx, test_idx) in enumerate(skf.split(texts, labels)):
-        logger.info("Processing fold %d/%d", fold + 1, k)
-        logger.info("Training instances %d", len(train_idx))
-        logger.info("Testing instances %d", len(test_idx))
-        
-        # Split data
-        train_texts, test_texts = texts[train_idx], texts[test_idx]
-        train_labels, test_labels = labels[train_idx], labels[test_idx]
-
-        # Class weights
-        if use_class_weights:
-            class_weights = compute_class_weight(
-                class_weight='balanced',
-                classes=np.unique(train_labels),
-                y=train_labels
-            )
-            class_weights = torch.tensor(class_weights, dtype=torch.float).to("cuda" if torch.cuda.is_available() else "cpu")
-        else:
-            class_weights = None
-        
-        # Preprocess
-        train_encodings, train_labels = preprocess_data(train_texts.tolist(), train_labels.tolist(), tokenizer)
-        test_encodings, test_labels = preprocess_data(test_texts.tolist(), test_labels.tolist(), tokenizer)
-        
-        # Replace TensorDataset with a list of dictionaries
-        train_dataset = [
-            {key: torch.tensor(val[i]) for key, val in train_encodings.items()} | {"labels": torch.tensor(train_labels[i])}
-            for i in range(len(train_labels))
-        ]
-        test_dataset = [
-            {key: torch.tensor(val[i]) for key, val in test_encodings.items()} | {"labels": torch.tensor(test_labels[i])}
-            for i in range(len(test_labels))
-        ]
-
-        # Load model
-        model = AutoModelForSequenceClassification.from_pretrained(
-            model_id, num_labels=len(MULTICLASS_LABEL_MAP) if multiclass else 2
-        )
-        
-        # Define training arguments
-        training_args = TrainingArguments(
-            output_dir=os.path.join(output_dir, f"fold-{fold}"),
-            num_train_epochs=10,
-            per_device_train_batch_size=16,
-            eval_strategy="epoch",
-            save_strategy="no",
-            report_to="none"
-        )
-        
-        # Define Trainer
-        trainer = CustomTrainer(
-            model=model,
-            args=training_args,
-            train_dataset=train_dataset,
-            eval_dataset=test_dataset,
-            compute_metrics=compute_metrics,
-            class_weights=class_weights
-        )
-        
-        # Train and evaluate
-        trainer.train()
-        eval_metrics = trainer.evaluate()
-        logger.info("Fold %d metrics: %s", fold + 1, eval_metrics)
-
-        # Collect fold metrics
+    for eval_metrics in all_eval_metrics:
         fold_metrics.append(eval_metrics["eval_average_metrics"])
         all_per_class_metrics.append(eval_metrics["eval_per_class_metrics"])
 
-        remove_empty_folders(output_dir)
-    
+    remove_empty_folders(output_dir)
+
+
     # Aggregate average metrics
     avg_metrics = aggregate_metrics(fold_metrics)
     logger.info("Average metrics across folds: %s", avg_metrics)
@@ -406,13 +500,13 @@ def compute_loss(model, inputs, return_outputs=False):
     return (loss, outputs) if return_outputs else loss
 
 def aggregate_metrics(fold_metrics):
-    avg_metrics = {
-        "accuracy": np.mean([metrics["eval_accuracy"] for metrics in fold_metrics]),
-        "precision": np.mean([np.mean(metrics["eval_precision"]) for metrics in fold_metrics]),
-        "recall": np.mean([np.mean(metrics["eval_recall"]) for metrics in fold_metrics]),
-        "f1": np.mean([np.mean(metrics["eval_f1"]) for metrics in fold_metrics])
+    # Stack each metric across folds once and reduce in C instead of the nested
+    # per-metric Python traversals
+    stacked = {
+        name: np.asarray([metrics[f"eval_{name}"] for metrics in fold_metrics])
+        for name in ("accuracy", "precision", "recall", "f1")
     }
-    return avg_metrics
+    return {name: values.mean().item() for name, values in stacked.items()}
 
 def save_metrics(metrics, output_csv):
     logger.info("Saving metrics to %s", output_csv)
@@ -427,7 +521,7 @@ def main():
     if args.multiclass:
         df = load_data(args.input_csv, True)
         display_emotion_counts(df)
-        texts = df['sentence'].to_numpy()
+        texts = df['sentence'].tolist()
         labels = df['labels'].to_numpy()
         avg_metrics = cross_validate_model(
             model_id=args.model_id,
@@ -442,7 +536,7 @@ def main():
     else:
         df, binary_labels = load_data(args.input_csv, False)
         display_emotion_counts_binary(df)
-        texts = df['sentence'].to_numpy()
+        texts = df['sentence'].tolist()
         avg_metrics = cross_validate_binary_models(
             model_id=args.model_id,
             tokenizer_id=args.tokenizer_id,
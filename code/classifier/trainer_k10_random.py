@@ -49,7 +49,9 @@ def load_trainer_args(fold_index):
         weight_decay=0.01,
         load_best_model_at_end=True,
     )'''
-    return TrainingArguments(output_dir="test_trainer", eval_strategy="epoch")
+    # save_strategy="no": k-fold runs only need the final metrics; the fold
+    # models are saved explicitly via trainer.save_model after evaluation
+    return TrainingArguments(output_dir="test_trainer", eval_strategy="epoch", save_strategy="no")
 
 
 def load_tokenizer():